@@ -5,9 +5,11 @@ Created on 30 12, 2014
 @author: Yongxiang Qiu
 '''
 
+import os, tempfile, time
+
 from datetime import datetime
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 try:
     from xml.etree import cElementTree as ElementTree
@@ -48,6 +50,9 @@ class ScanServerClient(object):
         except:
             raise Exception, 'Failed to create client to ' + self.__baseURL
         
+        # Singleton, so keep the progress history across re-construction.
+        if not hasattr(self, 'tracker'):
+            self.tracker = ScanProgress()
         
         
     def submitScan(self,scanXML=None,scanName='UnNamed'):
@@ -131,6 +136,7 @@ class ScanServerClient(object):
             print 'Scan %d deleted.'%scanID
         except:
             raise Exception, 'Failed to deleted scan '+str(scanID)
+        self.tracker.forget(scanID)
         return r.status_code
 
     def removeCompeletedScan(self):
@@ -152,12 +158,15 @@ class ScanServerClient(object):
             print 'All completed scans are deleted.'
         except:
             raise Exception, 'Failed to remove completed scan.'
+        self.tracker.forget_completed()
         return r.status_code
     
 
     def get_scan(self, scanID):
         '''
         Get information for the scan with the given ID.
+        The returned snapshot is also recorded in the client's tracker,
+        so ssc.tracker.eta(scanID) is available after repeated polling.
 
         :param scanID: scan ID
         :return: ScanInfo object
@@ -167,22 +176,35 @@ class ScanServerClient(object):
             r = requests.get(self.__baseURL+self.__scanResource+'/'+str(scanID))
         except:
             raise Exception, 'Failed to get info from scan '+str(scanID)
-        return ScanInfo(r.text)
+        info = ScanInfo(r.text)
+        self.tracker.update(info)
+        return info
 
 
-    def get_data(self, scanID):
+    def get_data(self, scanID, directory=None):
         '''
         Get data for the scan with the given ID.
 
+        When a directory is given, the response is streamed to disk instead of
+        being held in memory, for scans whose data is larger than RAM.
+
         :param scanID: scan ID
-        :return: ScanData object
+        :param directory: optional directory for the on-disk columns
+        :return: ScanData object, or ScanDataFile object when directory is given
         '''
         try:
             # Not sure what content type this is requesting, should be XML.
-            r = requests.get(self.__baseURL+self.__scanResource+'/'+str(scanID)+'/data')
+            r = requests.get(self.__baseURL+self.__scanResource+'/'+str(scanID)+'/data',
+                             stream=(directory is not None))
         except:
             raise Exception, 'Failed to get data from scan '+str(scanID)
-        return ScanData(r.text)
+        if directory is None:
+            return ScanData(r.text)
+        r.raw.decode_content = True
+        try:
+            return ScanDataFile(r.raw, directory)
+        finally:
+            r.close()
 
 
     #############Detailed Design Needed#############
@@ -432,7 +454,13 @@ class ScanInfo(object):
     def is_aborted(self):
         return (self.state == "Aborted")
     
+    def is_paused(self):
+        return (self.state == "Paused")
+    
     def progress(self):
+        if self.total_work <= 0:
+            # Nothing to do, so a finished scan is complete and any other is not started.
+            return 100.0 if self.is_finished() else 0.0
         return ((100.0 * self.completed_work) / self.total_work)
     
     def __str__(self):
@@ -440,6 +468,126 @@ class ScanInfo(object):
 
 
 
+class ScanProgress(object):
+    '''
+    The ScanProgress class estimates the work rate and ETA of scans from
+    successive ScanInfo snapshots, such as those obtained by polling
+    ScanServerClient.get_scan().
+
+    For each scan id the last 'size' snapshots are kept as
+    (time, performed_work_units) pairs in a fixed-size ring buffer. The rate is
+    the work done between the oldest and newest entry divided by the elapsed
+    time, which smooths over the window while keeping updates O(1).
+
+    Usage::
+
+    >>> tracker = ScanProgress()
+    >>> tracker.update(ssc.get_scan(153))
+    >>> tracker.eta(153)
+
+    :param size: number of snapshots kept per scan, at least 2
+    '''
+
+    def __init__(self, size=10):
+        if size < 2:
+            raise ValueError("ScanProgress: Expecting size of at least 2, not {}".format(size))
+        self.size = size
+        self.__history = {}
+        self.__info = {}
+
+    def update(self, info, timestamp=None):
+        '''
+        Record a ScanInfo snapshot.
+
+        :param info: ScanInfo object
+        :param timestamp: time of the snapshot in seconds, defaults to now
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        history = self.__history.get(info.id)
+        if history is None:
+            history = self.__history[info.id] = deque(maxlen=self.size)
+        elif history and info.completed_work < history[-1][1]:
+            # Work went backwards, e.g. the scan id was reused; start over.
+            history.clear()
+        elif info.is_running() and not self.__info[info.id].is_running():
+            # Resumed, so the rate only covers running time.
+            history.clear()
+        history.append((timestamp, info.completed_work))
+        self.__info[info.id] = info
+
+    def forget(self, scanID):
+        '''
+        Drop the history of a scan, e.g. after it was deleted.
+
+        :param scanID: scan ID
+        '''
+        self.__history.pop(scanID, None)
+        self.__info.pop(scanID, None)
+
+    def forget_completed(self):
+        '''
+        Drop the history of all scans last seen finished or aborted,
+        e.g. after the completed scans were removed from the server.
+        '''
+        for scanID, info in list(self.__info.items()):
+            if info.is_finished() or info.is_aborted():
+                self.forget(scanID)
+
+    def scans(self):
+        '''
+        :return: list of tracked scan ids
+        '''
+        return list(self.__history.keys())
+
+    def info(self, scanID):
+        '''
+        :param scanID: scan ID
+        :return: last ScanInfo recorded for the scan, or None
+        '''
+        return self.__info.get(scanID)
+
+    def rate(self, scanID):
+        '''
+        Smoothed work rate of a scan.
+
+        :param scanID: scan ID
+        :return: work units per second, or None if there is not enough history
+        '''
+        history = self.__history.get(scanID)
+        if not history or len(history) < 2:
+            return None
+        (t0, w0), (t1, w1) = history[0], history[-1]
+        if t1 <= t0:
+            return None
+        return (w1 - w0) / float(t1 - t0)
+
+    def eta(self, scanID):
+        '''
+        Estimated time until a scan completes.
+
+        :param scanID: scan ID
+        :return: remaining seconds, 0 for scans that are done, or None if
+                 unknown because the scan was paused, aborted or makes no progress
+        '''
+        info = self.__info.get(scanID)
+        if info is None or info.is_paused() or info.is_aborted():
+            return None
+        if info.is_finished():
+            return 0.0
+        remaining = info.total_work - info.completed_work
+        if remaining <= 0:
+            return 0.0
+        rate = self.rate(scanID)
+        if not rate or rate <= 0:
+            return None
+        return remaining / rate
+
+    def __str__(self):
+        return "ScanProgress{{ scans={} }}".format(self.scans())
+
+
+
 class ScanData(object):
     '''
     The ScanData class contains the data from a running or finished scan and
@@ -504,3 +652,338 @@ class ScanData(object):
             self.times[name] = times
             self.values[name] = values
         self.devices = list(self.values.keys())
+
+
+
+
+class ScanDataFile(object):
+    '''
+    The ScanDataFile class provides the same properties as ScanData, but is
+    constructed by streaming the raw XML response into files on disk, so the
+    scan data does not need to fit into memory.
+
+    The samples of each device are written in chunks to binary files in the
+    given directory and then opened as read-only numpy memory maps, which
+    the operating system pages in as they are accessed:
+
+    <directory>/<index>.time  - timestamps as float64
+    <directory>/<index>.value - values as float64
+
+    where index is the position of the device in the devices list.
+    As in ScanData, a repeated device name replaces the earlier device.
+    Files are written under temporary names and renamed into place, so on
+    POSIX systems the same directory can be reused while an earlier
+    ScanDataFile for it is still open. Windows cannot replace files that are
+    memory mapped, so there the earlier ScanDataFile must be released first,
+    otherwise an OSError is raised. Data files of devices beyond the new
+    devices list are removed.
+
+    Memory use is bounded by the chunk size as long as the samples of each
+    device arrive in id order, as sent by the scan server. Out-of-order
+    samples are sorted on disk, which holds a sort index of 8 bytes per
+    sample of that device in memory and reads the columns in random order.
+
+    The ScanDataFile class has the following properties:
+
+    times - dictionary of timestamp values as a memory-mapped NDArray and keyed by device name
+    values - dictionary of scan data values as a memory-mapped NDArray and keyed by device name
+    devices - list of device names
+    directory - directory holding the data files
+
+    Usage::
+
+    >>> data = ssc.get_data(153, directory='/scratch/scan153')
+    >>> for times, values in data.chunks('D_M:LS1_CA01:BPM_D1144:POSH_RD'):
+    ...     pass
+    >>> data.mean('D_M:LS1_CA01:BPM_D1144:POSH_RD')
+
+    :param source: file-like object or file name providing scan data in XML format
+    :param directory: directory for the data files, created if it does not exist
+    :param chunk: number of samples buffered in memory while writing and reading
+    '''
+
+    _ROOT_TAG = ScanData._ROOT_TAG
+    _NAME_TAG = ScanData._NAME_TAG
+    _TIME_TAG = ScanData._TIME_TAG
+    _VALUE_TAG = ScanData._VALUE_TAG
+    _DEVICE_TAG = ScanData._DEVICE_TAG
+    _SAMPLE_TAG = ScanData._SAMPLE_TAG
+    _SAMPLES_TAG = ScanData._SAMPLES_TAG
+    _SAMPLE_ID_ATT = ScanData._SAMPLE_ID_ATT
+
+    _ID_EXT = ".id"
+    _TIME_EXT = ".time"
+    _VALUE_EXT = ".value"
+
+    def __init__(self, source, directory, chunk=65536):
+        if chunk < 1:
+            raise ValueError("ScanDataFile: Expecting chunk of at least 1, not {}".format(chunk))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.chunk = chunk
+        self.times = OrderedDict()
+        self.values = OrderedDict()
+
+        root = None
+        device = None
+        samples = None
+        in_sample = False
+        try:
+            for event, element in ElementTree.iterparse(source, events=("start", "end")):
+                if root is None:
+                    root = element
+                    if root.tag != self._ROOT_TAG:
+                        raise ValueError("ScanDataFile: Expecting root tag '{}' not '{}'".format(self._ROOT_TAG, root.tag))
+                elif event == "start":
+                    if element.tag == self._DEVICE_TAG:
+                        device = _DeviceWriter(directory, chunk)
+                    elif element.tag == self._SAMPLES_TAG:
+                        samples = element
+                    elif element.tag == self._SAMPLE_TAG:
+                        in_sample = True
+                elif element.tag == self._SAMPLE_TAG:
+                    device.append(int(element.get(self._SAMPLE_ID_ATT)),
+                                  float(element.findtext(self._TIME_TAG)),
+                                  float(element.findtext(self._VALUE_TAG)))
+                    in_sample = False
+                    # Detach the parsed sample so memory does not grow with the device.
+                    samples.clear()
+                elif element.tag == self._NAME_TAG and device is not None and not in_sample:
+                    device.name = element.text
+                elif element.tag == self._DEVICE_TAG:
+                    if device.name in self.values:
+                        index = list(self.values.keys()).index(device.name)
+                        # Release the replaced device so its files can be replaced.
+                        self.times[device.name] = self.values[device.name] = None
+                    else:
+                        index = len(self.values)
+                    self.times[device.name], self.values[device.name] = \
+                        device.close(os.path.join(directory, str(index)))
+                    device = None
+                    samples = None
+                    root.clear()
+        except:
+            if device is not None:
+                device.abort()
+            raise
+        self.devices = list(self.values.keys())
+        self.__remove_stale()
+
+    def __remove_stale(self):
+        # Data files left by an earlier scan with more devices
+        for filename in os.listdir(self.directory):
+            index, ext = os.path.splitext(filename)
+            if ext in (self._TIME_EXT, self._VALUE_EXT) and index.isdigit() \
+               and int(index) >= len(self.devices):
+                _remove_file(os.path.join(self.directory, filename))
+
+    def chunks(self, name, size=None):
+        '''
+        Iterate over the samples of a device in chunks.
+
+        :param name: device name
+        :param size: number of samples per chunk, defaults to the chunk given on construction
+        :return: iterator of (times, values) NDArray tuples
+        '''
+        if size is None:
+            size = self.chunk
+        times = self.times[name]
+        values = self.values[name]
+        for start in xrange(0, len(values), size):
+            yield (numpy.array(times[start:start+size]), numpy.array(values[start:start+size]))
+
+    def min(self, name):
+        '''
+        :param name: device name
+        :return: minimum value of the device, NaN if any value is NaN, or None if there are no samples
+        '''
+        result = None
+        for _, values in self.chunks(name):
+            low = values.min()
+            result = low if result is None else numpy.minimum(result, low)
+        return result
+
+    def max(self, name):
+        '''
+        :param name: device name
+        :return: maximum value of the device, NaN if any value is NaN, or None if there are no samples
+        '''
+        result = None
+        for _, values in self.chunks(name):
+            high = values.max()
+            result = high if result is None else numpy.maximum(result, high)
+        return result
+
+    def mean(self, name):
+        '''
+        :param name: device name
+        :return: mean value of the device, or None if there are no samples
+        '''
+        total = 0.0
+        for _, values in self.chunks(name):
+            total += values.sum()
+        count = len(self.values[name])
+        if count == 0:
+            return None
+        return total / count
+
+    def histogram(self, name, bins=10, range=None):
+        '''
+        Histogram of the values of a device, see numpy.histogram.
+        NaN and infinite values are not counted.
+
+        :param name: device name
+        :param bins: number of bins
+        :param range: (lower, upper) range of the bins, defaults to (min, max) of the finite values
+        :return: tuple of (counts, bin edges) NDArrays
+        '''
+        if range is None:
+            range = self.__finite_range(name)
+        counts, edges = numpy.histogram(numpy.empty(0), bins=bins, range=range)
+        for _, values in self.chunks(name):
+            counts += numpy.histogram(values[numpy.isfinite(values)], bins=bins, range=range)[0]
+        return counts, edges
+
+    def __finite_range(self, name):
+        low = high = None
+        for _, values in self.chunks(name):
+            values = values[numpy.isfinite(values)]
+            if len(values) > 0:
+                low = values.min() if low is None else min(low, values.min())
+                high = values.max() if high is None else max(high, values.max())
+        if low is None:
+            return (0.0, 1.0)
+        return (low, high)
+
+
+class _DeviceWriter(object):
+    '''
+    Write the samples of one device to temporary files in chunks,
+    which close() renames to <path>.time and <path>.value
+
+    :param directory: directory of the data files
+    :param chunk: number of samples buffered before writing
+    '''
+
+    _EXTS = (ScanDataFile._ID_EXT, ScanDataFile._TIME_EXT, ScanDataFile._VALUE_EXT)
+
+    def __init__(self, directory, chunk):
+        self.name = None
+        self.__directory = directory
+        self.__chunk = chunk
+        self.__count = 0
+        self.__sorted = True
+        self.__last_id = None
+        self.__buffer = []
+        self.__files = []
+        self.__temp_paths = []
+        try:
+            for ext in self._EXTS:
+                fd, path = tempfile.mkstemp(suffix=ext, prefix=".tmp", dir=directory)
+                self.__temp_paths.append(path)
+                self.__files.append(os.fdopen(fd, "wb"))
+        except:
+            self.abort()
+            raise
+
+    def append(self, sid, time, value):
+        if self.__last_id is not None and sid < self.__last_id:
+            self.__sorted = False
+        self.__last_id = sid
+        self.__buffer.append((sid, time, value))
+        if len(self.__buffer) >= self.__chunk:
+            self.__flush()
+
+    def __flush(self):
+        if not self.__buffer:
+            return
+        ids, times, values = zip(*self.__buffer)
+        numpy.array(ids, dtype=numpy.int64).tofile(self.__files[0])
+        numpy.array(times, dtype=numpy.float64).tofile(self.__files[1])
+        numpy.array(values, dtype=numpy.float64).tofile(self.__files[2])
+        self.__count += len(self.__buffer)
+        self.__buffer = []
+
+    def abort(self):
+        '''
+        Close and remove the temporary files.
+        '''
+        for f in self.__files:
+            f.close()
+        for path in self.__temp_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.__files = []
+        self.__temp_paths = []
+
+    def close(self, path):
+        '''
+        Finish writing, move the data files into place and open them.
+
+        :param path: path of the data files without extension
+        :return: tuple of (times, values) memory-mapped NDArrays sorted by sample id
+        '''
+        try:
+            self.__flush()
+            for f in self.__files:
+                f.close()
+            self.__files = []
+            id_path, time_path, value_path = self.__temp_paths
+            if not self.__sorted:
+                self.__sort(id_path, time_path, value_path)
+            # Renaming keeps files that an earlier ScanDataFile has mapped intact.
+            _replace_file(time_path, path + ScanDataFile._TIME_EXT)
+            _replace_file(value_path, path + ScanDataFile._VALUE_EXT)
+            os.remove(id_path)
+            self.__temp_paths = []
+        except:
+            self.abort()
+            raise
+        return self.__open(path + ScanDataFile._TIME_EXT), self.__open(path + ScanDataFile._VALUE_EXT)
+
+    def __sort(self, id_path, time_path, value_path):
+        # The server sends samples in id order, so this is rarely needed.
+        # The sort index takes 8 bytes per sample in memory, and the columns
+        # are read in random order while they are copied in chunks.
+        order = numpy.argsort(numpy.memmap(id_path, dtype=numpy.int64, mode="r"), kind="mergesort")
+        for path in (time_path, value_path):
+            source = numpy.memmap(path, dtype=numpy.float64, mode="r")
+            fd, sorted_path = tempfile.mkstemp(suffix=".sorted", prefix=".tmp", dir=self.__directory)
+            try:
+                with os.fdopen(fd, "wb") as target:
+                    for start in xrange(0, self.__count, self.__chunk):
+                        source[order[start:start+self.__chunk]].tofile(target)
+                del source
+                _replace_file(sorted_path, path)
+            except:
+                os.remove(sorted_path)
+                raise
+
+    def __open(self, path):
+        # numpy cannot memory map an empty file
+        if self.__count == 0:
+            return numpy.empty(0)
+        return numpy.memmap(path, dtype=numpy.float64, mode="r")
+
+
+def _remove_file(path):
+    '''
+    Remove a data file, with a clear error where it is still memory mapped.
+    '''
+    try:
+        os.remove(path)
+    except OSError as e:
+        if os.name != 'nt':
+            raise
+        raise OSError(e.errno, "Cannot remove '{}', release the ScanDataFile using it first".format(path))
+
+
+def _replace_file(source, target):
+    '''
+    Rename source to target, replacing an existing target.
+    Python 2 has no os.replace and os.rename fails on Windows if target exists.
+    '''
+    if os.name == 'nt' and os.path.exists(target):
+        _remove_file(target)
+    os.rename(source, target)
@@ -0,0 +1,156 @@
+'''
+Offline tests for ScanDataFile, no scan server needed.
+'''
+
+import os, sys, shutil, subprocess, tempfile, unittest
+from StringIO import StringIO
+
+import numpy
+
+from ScanClient.ScanServerClient import ScanData, ScanDataFile
+
+def dataXML(devices):
+    '''
+    :param devices: list of (name, [(id, time, value), ...]) tuples
+    :return: scan data in XML format
+    '''
+    xml = '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n<data>\n'
+    for name, samples in devices:
+        xml += '<device>\n<name>{}</name>\n<samples>\n'.format(name)
+        for sid, time, value in samples:
+            xml += '<sample id="{}"><time>{!r}</time><value>{!r}</value></sample>\n'.format(sid, time, value)
+        xml += '</samples>\n</device>\n'
+    return xml + '</data>\n'
+
+_DEVICES = [ ('D_M:LS1_CA01:BPM_D1144:POSH_RD', [ (sid, 1424466313887.0 + sid, 0.5 * sid - 1.0) for sid in range(10) ]),
+             ('Unordered', [ (sid, 1000.0 + sid, -2.0 * sid) for sid in (3, 0, 7, 1, 2, 6, 4, 5) ]),
+             ('Empty', []) ]
+
+# Parse one device with the given number of samples from a streaming source
+# and print the peak memory use of the process.
+_MEMORY_SCRIPT = '''
+import resource, sys, tempfile
+from ScanClient.ScanServerClient import ScanDataFile
+
+class Source(object):
+    def __init__(self, count):
+        self.parts = self.generate(count)
+        self.pending = ''
+    def generate(self, count):
+        yield '<data><device><name>A</name><samples>'
+        for sid in xrange(count):
+            yield '<sample id="%d"><time>%d</time><value>%d.5</value></sample>' % (sid, sid, sid)
+        yield '</samples></device></data>'
+    def read(self, size=-1):
+        while len(self.pending) < size:
+            part = next(self.parts, None)
+            if part is None:
+                break
+            self.pending += part
+        result, self.pending = self.pending[:size], self.pending[size:]
+        return result
+
+data = ScanDataFile(Source(int(sys.argv[1])), tempfile.mkdtemp(dir=sys.argv[2]), chunk=1000)
+assert len(data.values['A']) == int(sys.argv[1])
+print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+'''
+
+class TestScanDataFile(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_as_scan_data(self):
+        xml = dataXML(_DEVICES)
+        expected = ScanData(xml)
+        data = ScanDataFile(StringIO(xml), self.directory, chunk=3)
+        self.assertEqual(data.devices, expected.devices)
+        for name in expected.devices:
+            numpy.testing.assert_array_equal(data.times[name], expected.times[name])
+            numpy.testing.assert_array_equal(data.values[name], expected.values[name])
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['0.time', '0.value', '1.time', '1.value', '2.time', '2.value'])
+
+    def test_wrong_root(self):
+        self.assertRaises(ValueError, ScanDataFile, StringIO('<scan></scan>'), self.directory)
+
+    def test_parse_error(self):
+        xml = dataXML(_DEVICES)
+        self.assertRaises(SyntaxError, ScanDataFile, StringIO(xml[:xml.find('Unordered') + 200]), self.directory)
+        # Only the first, complete device remains
+        self.assertEqual(sorted(os.listdir(self.directory)), ['0.time', '0.value'])
+
+    def test_reductions(self):
+        data = ScanDataFile(StringIO(dataXML(_DEVICES)), self.directory, chunk=3)
+        name = _DEVICES[0][0]
+        self.assertEqual(data.min(name), -1.0)
+        self.assertEqual(data.max(name), 3.5)
+        self.assertEqual(data.mean(name), 1.25)
+        counts, edges = data.histogram(name, bins=3)
+        numpy.testing.assert_array_equal(counts, [3, 3, 4])
+        numpy.testing.assert_array_equal(edges, [-1.0, 0.5, 2.0, 3.5])
+        counts, edges = data.histogram(name, bins=2, range=(0.0, 2.0))
+        numpy.testing.assert_array_equal(counts, [2, 3])
+        self.assertIsNone(data.min('Empty'))
+        self.assertIsNone(data.max('Empty'))
+        self.assertIsNone(data.mean('Empty'))
+        self.assertEqual(data.histogram('Empty', bins=2)[0].sum(), 0)
+
+    def test_histogram_not_finite(self):
+        samples = [ (0, 0.0, float('nan')), (1, 1.0, 1.0), (2, 2.0, float('inf')), (3, 3.0, 3.0) ]
+        data = ScanDataFile(StringIO(dataXML([ ('A', samples) ])), self.directory, chunk=1)
+        self.assertTrue(numpy.isnan(data.min('A')))
+        self.assertTrue(numpy.isnan(data.max('A')))
+        counts, edges = data.histogram('A', bins=2)
+        numpy.testing.assert_array_equal(counts, [1, 1])
+        numpy.testing.assert_array_equal(edges, [1.0, 2.0, 3.0])
+
+    def test_chunks(self):
+        data = ScanDataFile(StringIO(dataXML(_DEVICES)), self.directory, chunk=4)
+        name = _DEVICES[0][0]
+        chunks = list(data.chunks(name))
+        self.assertEqual([ len(values) for _, values in chunks ], [4, 4, 2])
+        numpy.testing.assert_array_equal(numpy.concatenate([ times for times, _ in chunks ]), data.times[name])
+        numpy.testing.assert_array_equal(numpy.concatenate([ values for _, values in chunks ]), data.values[name])
+        self.assertEqual([ len(values) for _, values in data.chunks(name, size=3) ], [3, 3, 3, 1])
+        self.assertEqual(list(data.chunks('Empty')), [])
+
+    def test_duplicate_device(self):
+        xml = dataXML([ ('A', [ (0, 0.0, 1.0) ]), ('A', [ (0, 0.0, 2.0), (1, 1.0, 3.0) ]), ('B', [ (0, 0.0, 4.0) ]) ])
+        expected = ScanData(xml)
+        data = ScanDataFile(StringIO(xml), self.directory)
+        self.assertEqual(data.devices, expected.devices)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['0.time', '0.value', '1.time', '1.value'])
+        # <index>.value holds the device at that index in the devices list
+        for index, name in enumerate(expected.devices):
+            numpy.testing.assert_array_equal(data.values[name], expected.values[name])
+            numpy.testing.assert_array_equal(numpy.fromfile(os.path.join(self.directory, '{}.value'.format(index))),
+                                             expected.values[name])
+
+    @unittest.skipIf(os.name == 'nt', 'memory mapped files cannot be replaced on Windows')
+    def test_reuse_directory(self):
+        first = ScanDataFile(StringIO(dataXML([ ('A', [ (sid, sid, sid) for sid in range(1000) ]),
+                                                ('B', [ (0, 0.0, 0.0) ]) ])), self.directory)
+        second = ScanDataFile(StringIO(dataXML([ ('A', [ (0, 0.0, 42.0) ]) ])), self.directory)
+        # The earlier data stays readable, stale files are removed
+        self.assertEqual(first.values['A'][999], 999.0)
+        self.assertEqual(second.values['A'][0], 42.0)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['0.time', '0.value'])
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'ru_maxrss is in KiB only on Linux')
+    def test_memory_bounded(self):
+        package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=package)
+        def peak(count):
+            output = subprocess.check_output([sys.executable, '-c', _MEMORY_SCRIPT, str(count), self.directory], env=env)
+            return int(output.split()[-1])
+        small = peak(20000)
+        large = peak(200000)
+        # ru_maxrss is in KiB. Keeping every sample would take about 10 MB more.
+        self.assertLess(large - small, 2 * 1024)
+
+if __name__ == '__main__':
+    unittest.main()
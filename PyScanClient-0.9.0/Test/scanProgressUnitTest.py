@@ -0,0 +1,99 @@
+'''
+Offline tests for ScanInfo.progress() and ScanProgress, no scan server needed.
+'''
+
+import unittest
+from ScanClient.ScanServerClient import ScanInfo, ScanProgress
+
+_SCAN_XML = '''<scan>
+    <id>{id}</id>
+    <name>test</name>
+    <created>1424465207911</created>
+    <state>{state}</state>
+    <runtime>0</runtime>
+    <total_work_units>{total}</total_work_units>
+    <performed_work_units>{performed}</performed_work_units>
+    <address>-1</address>
+    <command/>
+</scan>'''
+
+def scanInfo(performed, total=100, state='Running', scanID=1):
+    return ScanInfo(_SCAN_XML.format(id=scanID, state=state, total=total, performed=performed))
+
+class TestScanProgress(unittest.TestCase):
+
+    def test_progress(self):
+        self.assertEqual(scanInfo(25).progress(), 25.0)
+        self.assertEqual(scanInfo(0, total=0, state='Idle').progress(), 0.0)
+        self.assertEqual(scanInfo(0, total=0, state='Finished').progress(), 100.0)
+
+    def test_invalid_size(self):
+        self.assertRaises(ValueError, ScanProgress, 1)
+
+    def test_unknown_scan(self):
+        tracker = ScanProgress()
+        self.assertIsNone(tracker.rate(1))
+        self.assertIsNone(tracker.eta(1))
+        tracker.update(scanInfo(10), timestamp=0)
+        # A single snapshot gives no rate
+        self.assertIsNone(tracker.rate(1))
+        self.assertIsNone(tracker.eta(1))
+
+    def test_full_ring_buffer(self):
+        tracker = ScanProgress(size=3)
+        # Rate changes from 1 to 4 units/second, only the last 3 snapshots count
+        for timestamp, performed in ((0, 0), (1, 1), (2, 2), (3, 6), (4, 10)):
+            tracker.update(scanInfo(performed), timestamp=timestamp)
+        self.assertEqual(tracker.rate(1), 4.0)
+        self.assertEqual(tracker.eta(1), 90 / 4.0)
+        self.assertEqual(tracker.info(1).completed_work, 10)
+
+    def test_work_goes_backwards(self):
+        tracker = ScanProgress()
+        tracker.update(scanInfo(50), timestamp=0)
+        tracker.update(scanInfo(60), timestamp=1)
+        tracker.update(scanInfo(5), timestamp=2)
+        self.assertIsNone(tracker.rate(1))
+        tracker.update(scanInfo(7), timestamp=4)
+        self.assertEqual(tracker.rate(1), 1.0)
+        self.assertEqual(tracker.eta(1), 93.0)
+
+    def test_paused(self):
+        tracker = ScanProgress()
+        for timestamp in range(3):
+            tracker.update(scanInfo(40, state='Paused'), timestamp=timestamp)
+        self.assertEqual(tracker.rate(1), 0.0)
+        self.assertIsNone(tracker.eta(1))
+
+    def test_paused_and_resumed(self):
+        tracker = ScanProgress()
+        for timestamp in range(3):
+            tracker.update(scanInfo(10 * timestamp), timestamp=timestamp)
+        self.assertEqual(tracker.eta(1), 8.0)
+        for timestamp in range(3, 12):
+            tracker.update(scanInfo(20, state='Paused'), timestamp=timestamp)
+            self.assertIsNone(tracker.eta(1))
+        # The rate after resuming does not include the pause
+        tracker.update(scanInfo(20), timestamp=12)
+        self.assertIsNone(tracker.rate(1))
+        tracker.update(scanInfo(30), timestamp=13)
+        self.assertEqual(tracker.rate(1), 10.0)
+        self.assertEqual(tracker.eta(1), 7.0)
+
+    def test_finished_and_aborted(self):
+        tracker = ScanProgress()
+        tracker.update(scanInfo(10, scanID=1), timestamp=0)
+        tracker.update(scanInfo(100, state='Finished', scanID=1), timestamp=1)
+        tracker.update(scanInfo(10, scanID=2), timestamp=0)
+        tracker.update(scanInfo(20, state='Aborted', scanID=2), timestamp=1)
+        tracker.update(scanInfo(10, scanID=3), timestamp=0)
+        self.assertEqual(tracker.eta(1), 0.0)
+        self.assertIsNone(tracker.eta(2))
+        tracker.forget_completed()
+        self.assertEqual(tracker.scans(), [3])
+        tracker.forget(3)
+        self.assertEqual(tracker.scans(), [])
+        self.assertIsNone(tracker.info(3))
+
+if __name__ == '__main__':
+    unittest.main()